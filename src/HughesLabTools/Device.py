@@ -1,18 +1,82 @@
+import collections
+import errno
 import os
+import threading
 from ij import IJ
-from ij import ImageStack, ImagePlus
-from ij.plugin import ZProjector
-from java.lang import System
+from ij.process import Blitter, ColorProcessor, FloatProcessor
+from java.util.concurrent import Callable, FutureTask
 from HughesLabTools.DeviceImage import DeviceImage
 
+
+def _ensure_abs(path):
+    """Returns an absolute path, only resolving against the working directory when needed."""
+    return path if os.path.isabs(path) else os.path.abspath(path)
+
+
+def _makedirs(directory):
+    """Creates a directory and its parents, ignoring the error if it already exists."""
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _settings_path(output_path):
+    """Returns the path of the hidden file recording the settings an output was made with."""
+    directory, name = os.path.split(output_path)
+    return os.path.join(directory, '.{}.settings'.format(name))
+
+
+def _read_settings(output_path):
+    """Returns the settings recorded for an output, or None if there are none."""
+    try:
+        with open(_settings_path(output_path)) as settings_file:
+            return settings_file.read()
+    except IOError:
+        return None
+
+
+def _write_settings(output_path, settings):
+    """Records the settings an output was made with, next to the output."""
+    with open(_settings_path(output_path), 'w') as settings_file:
+        settings_file.write(settings)
+
+
+class _ColorTask(Callable):
+    """Colors the images of one type of a device, in order, on an executor thread."""
+
+    def __init__(self, device, jobs):
+        self.device = device
+        self.jobs = jobs
+
+    def call(self):
+        for args in self.jobs:
+            self.device._apply_color_to_single_image(*args)
+
+
 class Device:
-    def __init__(self, typeNames, name=None, deviceDir=None, verbose=False):
+    def __init__(self, typeNames, name=None, deviceDir=None, verbose=False, executor=None, results_cache=None,
+                 options=None):
         self.name = name
         self.typeNames = typeNames
         self.deviceDir = deviceDir
         self.verbose = verbose
+        # Shared executor used to color images in parallel; None colors them one at a time
+        self.executor = executor
+        # ResultsCache shared by the devices of a run; None always recomputes outputs
+        self.results_cache = results_cache
+        self.options = options if options else {}
+        # Paths per type are kept as OrderedDict keys (values unused) for O(1) membership and removal
         self.image_paths = {image_type: None for image_type in typeNames}
         self.colored_image_paths = {image_type: None for image_type in typeNames}
+        self._colored_images = {}
+
+        # Prefetch buffer: pixels decoded ahead of the color stage, keyed by absolute path (oldest first).
+        # Each entry is handed over to the one load that reads it, so no image is held twice.
+        self._img_cache = collections.OrderedDict()
+        self._img_cache_size = 2 * len(typeNames)
+        self._img_cache_lock = threading.Lock()
 
     def log(self, message, level="INFO"):
         if level == "ERROR":
@@ -35,30 +99,37 @@ class Device:
             self._set_image_paths_from_list(image_type, image_paths)
         elif image_type and image_path:
             self._set_image_path(image_type, image_path)
-        self.log("Set image path for {}: {}".format(image_type, self.image_paths[image_type]))
+        self.log("Set image path for {}: {}".format(image_type, self.get_image_paths(image_type)))
 
     def _set_image_paths_from_dict(self, image_paths):
         for img_type, img_path in image_paths.items():
             if img_type in self.image_paths:
-                self.image_paths[img_type] = os.path.abspath(img_path)
+                self.image_paths[img_type] = collections.OrderedDict.fromkeys([_ensure_abs(img_path)])
 
     def _set_image_paths_from_list(self, image_type, image_paths):
-        self.image_paths[image_type] = [os.path.abspath(path) for path in image_paths]
+        self.image_paths[image_type] = collections.OrderedDict.fromkeys(_ensure_abs(path) for path in image_paths)
 
     def _set_image_path(self, image_type, image_path):
         if image_type in self.image_paths:
             if self.image_paths[image_type] is None:
-                self.image_paths[image_type] = []
-            self.image_paths[image_type].append(os.path.abspath(image_path))
+                self.image_paths[image_type] = collections.OrderedDict()
+            self.image_paths[image_type][_ensure_abs(image_path)] = None
 
     def get_image_paths(self, image_type=None):
+        """Returns the list of image paths for a type (None if it has none), or a dict of them for all types."""
         if image_type:
-            return self.image_paths.get(image_type, [])
-        return self.image_paths
+            if image_type not in self.image_paths:
+                return []
+            return self._as_path_list(self.image_paths[image_type])
+        return {img_type: self._as_path_list(paths) for img_type, paths in self.image_paths.items()}
+
+    @staticmethod
+    def _as_path_list(paths):
+        return list(paths) if paths is not None else None
 
     def set_colored_image_path(self, image_type, image_path):
         if image_type in self.colored_image_paths:
-            self.colored_image_paths[image_type] = os.path.abspath(image_path)
+            self.colored_image_paths[image_type] = _ensure_abs(image_path)
             self.log("Set colored image path for {}: {}".format(image_type, self.colored_image_paths[image_type]))
 
     def get_colored_image_paths(self, image_type=None):
@@ -74,20 +145,21 @@ class Device:
             image_path (str): The file path of the image to update.
             old_type (str): The current image type of the image.
             new_type (str): The new image type to assign.
-            image (DeviceImage): The loaded image object.
+            image (ImagePlus): The loaded image object, if any.
         """
         # Ensure the old type exists in the image_paths dictionary
         if old_type in self.image_paths:
-            if image_path in self.image_paths[old_type]:
+            old_paths = self.image_paths[old_type]
+            if old_paths and image_path in old_paths:
                 # Remove the image from the old type
-                self.image_paths[old_type].remove(image_path)
-                if not self.image_paths[old_type]:  # Clean up empty lists
+                del old_paths[image_path]
+                if not old_paths:  # Clean up empty types
                     self.image_paths[old_type] = None
 
             # Add the image to the new type
-            if new_type not in self.image_paths or self.image_paths[new_type] is None:
-                self.image_paths[new_type] = []
-            self.image_paths[new_type].append(image_path)
+            if self.image_paths.get(new_type) is None:
+                self.image_paths[new_type] = collections.OrderedDict()
+            self.image_paths[new_type][image_path] = None
 
             # Log the change if verbose mode is enabled
             self.log("Updated image type for {} from {} to {}.".format(image_path, old_type, new_type))
@@ -97,50 +169,131 @@ class Device:
 
     def apply_color_to_images(self, typeColors, sat=0.3, show_colored=False):
         """Applies color to all images of this device."""
+        output_directory = self._colored_directory()
+        tasks = []
         for img_type, color in zip(self.typeNames, typeColors):
             image_paths = self.get_image_paths(img_type)
             if not image_paths:
                 self.log("No image paths found for device: {}, type: {}".format(self.name, img_type))
                 continue
 
-            if not isinstance(image_paths, list):
-                image_paths = [image_paths]
-
-            for image_path in image_paths:
-                self._apply_color_to_single_image(img_type, color, image_path, sat, show_colored)
+            # Types are colored in parallel, but a type's images one after another, so the colored
+            # path recorded for a type with several images is always that of its last image
+            tasks.append(_ColorTask(self, [(img_type, color, image_path, sat, show_colored, output_directory)
+                                           for image_path in image_paths]))
+
+        # Create the output directory once for the device rather than checking for it per image
+        if tasks:
+            _makedirs(output_directory)
+        self._run_tasks(tasks)
+
+    def _run_tasks(self, tasks):
+        """Runs independent tasks on the shared executor, or one at a time when there is none."""
+        if self.executor is None or len(tasks) < 2:
+            for task in tasks:
+                task.call()
+            return
+
+        futures = [FutureTask(task) for task in tasks]
+        for future in futures[1:]:
+            self.executor.execute(future)
+
+        # This thread may itself belong to the executor, so never block on a task that is still queued:
+        # run anything not yet started here (a no-op for started tasks), then wait for the rest.
+        for future in futures:
+            future.run()
+        for future in futures:
+            future.get()
 
     def _load_image(self, image_path, verbose=False):
-        """Loads an image from the given path using DeviceImage with lazy loading."""
+        """
+        Loads an image from the given path using DeviceImage, taking its pixels from the prefetch
+        buffer when they have already been decoded.
+        """
+        key = _ensure_abs(image_path)
+        with self._img_cache_lock:
+            processor = self._img_cache.pop(key, None)
+
+        if processor is not None:
+            # Nothing else reads the prefetched pixels, so they are handed over without a copy
+            image = DeviceImage(image_path=image_path, verbose=verbose)
+            image.setProcessor(processor)
+            image._loaded = True
+            return image
+
         try:
             # Create a DeviceImage instance
             image = DeviceImage(image_path=image_path, verbose=verbose)
 
             # Perform lazy loading of the image
             image._lazy_load()
-
-            return image
         except Exception as e:
             self.log("Error loading image from path {}: {}".format(image_path, str(e)))
             raise
 
-    def _apply_color_to_single_image(self, img_type, color, image_path, sat, show_colored):
+        return image
+
+    def prefetch_images(self, typeColors, sat=0.3):
+        """
+        Decodes this device's source images into the prefetch buffer ahead of processing,
+        skipping those whose colored output is up to date, since the color stage will not load them.
+        """
+        output_directory = self._colored_directory()
+        for img_type, color in zip(self.typeNames, typeColors):
+            image_paths = self.get_image_paths(img_type)
+            if not image_paths:
+                continue
+
+            for image_path in image_paths:
+                key = _ensure_abs(image_path)
+                with self._img_cache_lock:
+                    if key in self._img_cache:
+                        continue
+                output_path, cache_key, settings = self._colored_output(image_path, color, sat, output_directory)
+                if self._output_is_current(output_path, [image_path], cache_key, settings):
+                    continue
+                image = DeviceImage(image_path=image_path, verbose=self.verbose)
+                image._lazy_load()
+                self._cache_processor(key, image.getProcessor())
+                self.log("Prefetched image: {}".format(image_path))
+
+    def _cache_processor(self, key, processor):
+        """Stores decoded pixels in the prefetch buffer, evicting the oldest entries."""
+        with self._img_cache_lock:
+            self._img_cache.pop(key, None)
+            self._img_cache[key] = processor
+            while len(self._img_cache) > self._img_cache_size:
+                self._img_cache.popitem(last=False)
+
+    def clear_image_cache(self):
+        """Releases any prefetched pixels this device has not used."""
+        with self._img_cache_lock:
+            self._img_cache.clear()
+
+    def _apply_color_to_single_image(self, img_type, color, image_path, sat, show_colored, output_directory):
         try:
-            # Load the image
+            output_path, cache_key, settings = self._colored_output(image_path, color, sat, output_directory)
+
+            # Skip the work entirely if the existing colored image is still valid
+            if self._can_reuse_output(output_path, [image_path], cache_key, settings):
+                self.log("Colored image is up to date: {}".format(output_path))
+                self._set_colored_result(img_type, output_path)
+                if show_colored:
+                    self._load_image(output_path).show()
+                return
+
+            # Load the image, using the prefetched pixels if they are ready
             image = self._load_image(image_path, verbose=self.verbose)
 
             # Apply color to the image
             image.apply_color(color, sat)
 
             # Save the colored image
-            output_directory = os.path.join(self.get_deviceDir(), 'colored')
-            if not os.path.exists(output_directory):
-                os.makedirs(output_directory)
-
-            base, ext = os.path.splitext(image_path)
-            new_filename = "{}_colored{}".format(os.path.basename(base), ext)
-            output_path = os.path.join(output_directory, new_filename)
-
-            image.save(output_path)
+            # A failed save leaves whatever an earlier run wrote there, which must not be recorded as this result
+            if image.save(output_path, create_dir=False):
+                _write_settings(output_path, settings)
+                if cache_key:
+                    self.results_cache.store(cache_key, output_path)
 
             # Show the colored image if requested
             if show_colored:
@@ -148,11 +301,24 @@ class Device:
 
             self.log("Saved colored image at: {}".format(output_path))
 
-            self.set_colored_image_path(img_type, output_path)
+            # Hand the colored image to merge_images so it does not decode the file we just wrote
+            self._set_colored_result(img_type, output_path, image if self.options.get('merge') else None)
 
         except Exception as e:
             self.log("Error applying color to image: {}. Exception: {}".format(image_path, str(e)), level="WARNING")
 
+    def _set_colored_result(self, img_type, output_path, image=None):
+        """
+        Records the colored path of a type together with its in-memory image, if any.
+
+        Images are keyed by their colored path, so merge_images can never pair one file's path with
+        another file's pixels; the image of a path this one replaces is released.
+        """
+        self._colored_images.pop(self.get_colored_image_paths(img_type), None)
+        self.set_colored_image_path(img_type, output_path)
+        if image is not None:
+            self._colored_images[self.get_colored_image_paths(img_type)] = image
+
     def merge_images(self, show_merged=False):
         """Merge colored images for this device."""
         try:
@@ -161,31 +327,47 @@ class Device:
                 colored_image_paths = self.get_colored_image_paths(img_type)
                 if not isinstance(colored_image_paths, list):
                     colored_image_paths = [colored_image_paths]
-                all_colored_image_paths.extend([path for path in colored_image_paths if path])
+                for path in colored_image_paths:
+                    if path:
+                        all_colored_image_paths.append(path)
 
             if all_colored_image_paths:
                 # Log the colored image paths to confirm they exist
                 self.log("Colored image paths to merge: {}".format(all_colored_image_paths))
 
-                # Create DeviceImage objects for all colored image paths
-                images = [self._load_image(path) for path in all_colored_image_paths]
+                output_directory = os.path.join(self.get_deviceDir(), 'merged')
+                _makedirs(output_directory)
 
-                # Log the loaded images to confirm they are correctly loaded
-                self.log("Loaded {} images for merging.".format(len(images)))
+                new_filename = "{}_merged.tif".format(self.name)
+                output_path = os.path.join(output_directory, new_filename)
+
+                # Colored files are only rewritten when their source or settings change, so an
+                # unchanged set of colored inputs means the previous merge is still valid
+                cache_key = self.results_cache.make_key(all_colored_image_paths) if self.results_cache else None
+                settings = "inputs={}".format(all_colored_image_paths)
+                if self._can_reuse_output(output_path, all_colored_image_paths, cache_key, settings):
+                    self.log("Merged image is up to date: {}".format(output_path))
+                    self._colored_images.clear()
+                    if show_merged:
+                        self._load_image(output_path).show()
+                    return
+
+                # Use the images colored in this run, only reading from disk the ones that are not in memory.
+                # A generator hands them over one at a time, so only one input is held while summing.
+                images = (self._get_colored_image(path) for path in all_colored_image_paths)
 
                 # Merge all images into a single image
                 merged_image = self._merge_images(images)
 
-                # Save the merged image
-                output_directory = os.path.join(self.get_deviceDir(), 'merged')
-                if not os.path.exists(output_directory):
-                    os.makedirs(output_directory)
-
-                new_filename = "{}_merged.tif".format(self.name)
-                output_path = os.path.join(output_directory, new_filename)
+                # Log the merged images to confirm they were all loaded
+                self.log("Merged {} images.".format(len(all_colored_image_paths)))
 
-                merged_image.save(output_path)
-                self.log("Merged image saved for device: {}".format(self.name))
+                # Save the merged image
+                if merged_image.save(output_path, create_dir=False):
+                    _write_settings(output_path, settings)
+                    if cache_key:
+                        self.results_cache.store(cache_key, output_path)
+                    self.log("Merged image saved for device: {}".format(self.name))
 
                 if show_merged:
                     merged_image.show()
@@ -195,67 +377,119 @@ class Device:
         except Exception as e:
             self.log("Error merging images for device: {}. Exception: {}".format(self.name, str(e)), level="WARNING")
 
-    def _crop_to_smallest_dimensions(self, images):
-        """Crops all images to the dimensions of the smallest image in the list."""
-        if not images:
-            raise ValueError("No images provided for cropping.")
+    def _colored_directory(self):
+        return os.path.join(self.get_deviceDir(), 'colored')
 
-        # Find the minimum width and height among all images
-        min_width = min(img.getWidth() for img in images)
-        min_height = min(img.getHeight() for img in images)
+    def _colored_output(self, image_path, color, sat, output_directory):
+        """Returns the colored output path of a source image, with its results cache key and settings."""
+        base, ext = os.path.splitext(image_path)
+        output_path = os.path.join(output_directory, "{}_colored{}".format(os.path.basename(base), ext))
+        cache_key = self.results_cache.make_key([image_path], color, sat) if self.results_cache else None
+        return output_path, cache_key, "color={} sat={}".format(color, sat)
 
-        self.log("Cropping all images to the minimum dimension of images in the device: {}x{}".format(min_width, min_height))
+    def _can_reuse_output(self, output_path, input_paths, cache_key=None, settings=None):
+        """
+        Returns True if output_path already holds the result for the given inputs, restoring it from
+        the results cache when that is enabled.
+        """
+        if not self._output_is_current(output_path, input_paths, cache_key, settings):
+            return False
+        if self.results_cache:
+            if not self.results_cache.lookup(cache_key, output_path):
+                return False
+            # Keep the recorded settings in step with the restored output for runs without the cache
+            if settings is not None:
+                _write_settings(output_path, settings)
+        return True
+
+    def _output_is_current(self, output_path, input_paths, cache_key=None, settings=None):
+        """
+        Returns True if the result for the given inputs exists, without writing any file.
 
-        # Crop each image to the minimum dimensions
-        cropped_images = []
-        for img in images:
-            try:
-                img._lazy_load()
-                processor = img.getProcessor()
-                # Set the region of interest (ROI) and crop
-                processor.setRoi(0, 0, min_width, min_height)
-                cropped_processor = processor.crop()
-
-                # Create a new DeviceImage with the cropped processor
-                cropped_image = DeviceImage(title=img.getTitle(), img=cropped_processor)
-                cropped_images.append(cropped_image)
-            finally:
-                img.close()
-                System.gc()
-
-        return cropped_images
+        The 'force' option always recomputes. With a results cache, the cache key decides, since it also
+        covers the processing settings; otherwise the output is reused when it was made with the same
+        settings (e.g. the color, which changes when an image is moved to another type) and is at least
+        as new as every input.
+        """
+        if self.options.get('force', False):
+            return False
+        if self.results_cache:
+            return self.results_cache.contains(cache_key)
+        if _read_settings(output_path) != settings:
+            return False
+        try:
+            output_mtime = os.path.getmtime(output_path)
+        except OSError:
+            return False
+        return all(os.path.getmtime(path) <= output_mtime for path in input_paths)
+
+    def clear_colored_images(self):
+        """Releases the colored images kept in memory for merge_images."""
+        self._colored_images.clear()
+
+    def _get_colored_image(self, image_path):
+        """Returns the colored image kept in memory for a path, falling back to loading it from disk."""
+        image = self._colored_images.pop(image_path, None)
+        if image is None:
+            image = self._load_image(image_path)
+        return image
 
     def _merge_images(self, images):
-        """Helper function to merge a list of DeviceImage instances, optionally cropping them if needed."""
-        if not images:
-            raise ValueError("No images provided for merging.")
-
-        # Get the dimensions of the first image
-        first_width = images[0].getWidth()
-        first_height = images[0].getHeight()
-
-        # Check if all images have the same dimensions
-        if all(img.getWidth() == first_width and img.getHeight() == first_height for img in images):
-            self.log(
-                "All images have the same dimensions: {}x{}. No cropping needed.".format(first_width, first_height))
-        else:
-            # Crop images to the smallest dimensions if they don't match
-            images = self._crop_to_smallest_dimensions(images)
-
-        # Merge the images
-        min_width = images[0].getWidth()
-        min_height = images[0].getHeight()
-        stack = ImageStack(min_width, min_height)
+        """
+        Helper function to sum DeviceImage instances over the region they all share.
 
+        Images are consumed one at a time, so passing an iterator keeps a single input in memory.
+        """
+        sums = None
+        channel_fp = None
+        titles = []
+        cropped = False
         for img in images:
             ip = img.getProcessor()
-            stack.addSlice(ip)
-
-        imp = ImagePlus('', stack)
-        merged_imp = ZProjector.run(imp, 'sum')
-        titles = [img.getTitle() for img in images]
-        merged_imp.setTitle('_'.join(titles) + '_merged')
+            if sums is None:
+                # Sum straight into one float accumulator per channel; no intermediate stack is built
+                sums = [FloatProcessor(ip.getWidth(), ip.getHeight()) for _ in range(ip.getNChannels())]
+            elif ip.getWidth() < sums[0].getWidth() or ip.getHeight() < sums[0].getHeight():
+                # Shrink the running sums to the region this image shares with the previous ones
+                width = min(ip.getWidth(), sums[0].getWidth())
+                height = min(ip.getHeight(), sums[0].getHeight())
+                sums = [self._crop_processor(acc, width, height) for acc in sums]
+                cropped = True
+
+            # copyBits clips larger images to the accumulator, so no cropped copies are needed.
+            # Both the channel conversion and the add run as Java array loops; the float buffer is
+            # reused across channels and images rather than allocated for each one.
+            for channel, acc in enumerate(sums):
+                channel_fp = ip.toFloat(channel, channel_fp)
+                acc.copyBits(channel_fp, 0, 0, Blitter.ADD)
+            titles.append(img.getTitle())
+
+        if sums is None:
+            raise ValueError("No images provided for merging.")
 
-        # Convert ImagePlus to DeviceImage
-        return DeviceImage(title=merged_imp.getTitle(), img=merged_imp.getProcessor())
+        width, height = sums[0].getWidth(), sums[0].getHeight()
+        if cropped:
+            self.log("Cropped all images to the minimum dimension of images in the device: {}x{}".format(width, height))
+        else:
+            self.log("All images have the same dimensions: {}x{}. No cropping needed.".format(width, height))
 
+        if len(sums) == 1:
+            # The accumulator is only used for this merge, so it becomes the result as is
+            merged_ip = sums[0]
+            merged_ip.resetMinAndMax()
+        else:
+            # Scale each channel sum back to 8 bits, as the RGB sum projection does
+            merged_ip = ColorProcessor(width, height)
+            channel_pixels = []
+            for acc in sums:
+                acc.resetMinAndMax()
+                channel_pixels.append(acc.convertToByte(True).getPixels())
+            merged_ip.setRGB(*channel_pixels)
+
+        return DeviceImage(title='_'.join(titles) + '_merged', img=merged_ip)
+
+    @staticmethod
+    def _crop_processor(processor, width, height):
+        """Returns the top-left width x height region of a processor."""
+        processor.setRoi(0, 0, width, height)
+        return processor.crop()
@@ -1,8 +1,24 @@
-from ij import IJ, ImagePlus, Prefs
+from ij import IJ, ImagePlus
+from ij.plugin import ContrastEnhancer
+from ij.process import ImageProcessor, LUT
+from java.awt import Color
 import os
 
 
 class DeviceImage(ImagePlus):
+    # Colors offered for coloring images, matching ImageJ's LUT commands of the same name
+    _LUT_COLORS = {
+        'Red': Color.red,
+        'Green': Color.green,
+        'Blue': Color.blue,
+        'Cyan': Color.cyan,
+        'Magenta': Color.magenta,
+        'Yellow': Color.yellow,
+        'Grays': Color.white,
+    }
+    # LUTs built so far, shared by every image
+    _luts = {}
+
     def __init__(self, title=None, img=None, image_path=None, verbose=False):
         self.image_path = image_path
         self._loaded = False
@@ -33,29 +49,47 @@ class DeviceImage(ImagePlus):
     def _lazy_load(self):
         if not self._loaded and self.image_path:
             self.log("INFO: Attempting to load image from path: {}".format(self.image_path))
-            if not os.path.exists(self.image_path):
-                raise IOError("File not found at path: {}".format(self.image_path))
-            if not os.access(self.image_path, os.R_OK):
-                raise IOError("File not accessible (read permission denied) at path: {}".format(self.image_path))
             try:
                 img = IJ.openImage(self.image_path)
-                if img:
-                    self.setProcessor(img.getProcessor())
-                    self._loaded = True
-                    self.log("INFO: Loaded image successfully from path: {}".format(self.image_path))
-                else:
-                    raise IOError("Failed to load image from path: {}".format(self.image_path))
             except Exception as e:
                 raise IOError("INFO: Error loading image from path: {}. Exception: {}".format(self.image_path, str(e)))
 
+            if not img:
+                # Only touch the filesystem again to explain a failure; successful loads need a single open
+                if not os.path.exists(self.image_path):
+                    raise IOError("File not found at path: {}".format(self.image_path))
+                if not os.access(self.image_path, os.R_OK):
+                    raise IOError("File not accessible (read permission denied) at path: {}".format(self.image_path))
+                raise IOError("Failed to load image from path: {}".format(self.image_path))
+
+            self.setProcessor(img.getProcessor())
+            self._loaded = True
+            self.log("INFO: Loaded image successfully from path: {}".format(self.image_path))
+
     def apply_color(self, color, sat=0.3):
         self._lazy_load()
         if not self._loaded:
             raise IOError("Image not loaded, cannot apply color")
 
-        IJ.run(self, "Enhance Contrast...", "saturated={} normalize".format(sat))
-        IJ.run(self, color.title(), "")
-        IJ.run(self, "RGB Color", "")
+        # Equivalent of running "Enhance Contrast..." (normalize), the color LUT command and "RGB Color",
+        # done with direct processor calls: the stretch only sets the display range, and the RGB
+        # conversion renders through the LUT and that range in a single pass over the pixels.
+        ip = self.getProcessor()
+        ip.setLut(self._get_lut(color))
+        ContrastEnhancer().stretchHistogram(ip, sat)
+        self.setProcessor(ip.convertToRGB())
+
+    @classmethod
+    def _get_lut(cls, color):
+        """Returns the LUT for a color name, building it on first use."""
+        name = color.title()
+        lut = cls._luts.get(name)
+        if lut is None:
+            if name not in cls._LUT_COLORS:
+                raise ValueError("Unsupported color: {}".format(color))
+            lut = LUT.createLutFromColor(cls._LUT_COLORS[name])
+            cls._luts[name] = lut
+        return lut
 
     def duplicate_and_rename(self, suffix):
         """
@@ -75,16 +109,47 @@ class DeviceImage(ImagePlus):
         Applies thresholding and converts the duplicated image to a mask.
         """
         thresholded_image = self.duplicate_and_rename('_threshold')
-        IJ.setAutoThreshold(thresholded_image, method)
-        Prefs.blackBackground = black_background
-        IJ.run(thresholded_image, 'Convert to Mask', '')
+        self.convert_to_mask(thresholded_image, method, black_background)
         return thresholded_image
 
-    def save(self, file_path):
+    @staticmethod
+    def convert_to_mask(imp, method='Li dark b&w', black_background=True):
+        """
+        Auto-thresholds an image and replaces its processor with the binary mask.
+
+        Equivalent to IJ.setAutoThreshold followed by 'Convert to Mask', but the black background
+        setting is applied to this image only instead of through the global Prefs.blackBackground,
+        so masks can be made from several threads at once.
+
+        :param imp: The ImagePlus to threshold in place
+        :param method: An auto-threshold method string such as 'Li dark b&w'
+        :param black_background: If False, the mask gets an inverted LUT (black objects on white)
+        """
+        tokens = method.split()
+        ip = imp.getProcessor()
+        ip.setAutoThreshold(tokens[0], 'dark' in tokens, ImageProcessor.NO_LUT_UPDATE)
+        mask = ip.createMask()
+        if not black_background:
+            mask.invertLut()
+        imp.setProcessor(mask)
+
+    def save(self, file_path, create_dir=True):
+        """
+        Saves the image to file_path.
+
+        :param file_path: The path to save the image to
+        :param create_dir: Whether to create the parent directory if needed; callers that created it
+                           once up front pass False to skip the per-image check
+        """
         self._lazy_load()
         directory = os.path.dirname(file_path)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+        if create_dir and not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Images are saved from several threads, so another one may have created it first
+                if not os.path.isdir(directory):
+                    raise
         try:
             IJ.save(self, file_path)
             self.log("INFO: Image saved successfully at {}".format(file_path))
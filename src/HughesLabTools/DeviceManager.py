@@ -1,10 +1,157 @@
 from __future__ import print_function, division, absolute_import
+import collections
 import os
 import re
-from java.lang import System
+import threading
+from java.lang import Integer, Runtime, System, Thread
+from java.nio.file import Files, FileVisitOption, FileVisitResult, Paths, SimpleFileVisitor
+from java.util import EnumSet
+from java.util.concurrent import Callable, Executors, LinkedBlockingQueue
 from HughesLabTools.Device import Device
+from HughesLabTools.ResultsCache import ResultsCache
 from HughesLabTools.gui import VmoToolsGui, ImageTypeChangerGui
 
+_NAT_SORT_RE = re.compile(r'([0-9]+)')
+# Output directories written by this package, never searched for input images
+_SKIPPED_DIRS = ('colored', 'merged', ResultsCache.CACHE_DIR_NAME)
+
+
+class _DeviceTask(Callable):
+    """Runs the color and merge stages for a single device on a pool thread."""
+
+    def __init__(self, manager, device, prefetcher=None):
+        self.manager = manager
+        self.device = device
+        self.prefetcher = prefetcher
+
+    def call(self):
+        # Once a worker picks this device up, start decoding the device waiting behind it
+        if self.prefetcher:
+            self.prefetcher.device_started(self.device)
+        try:
+            self.manager._process_device(self.device)
+        except Exception as e:
+            self.manager.log("Error processing device: {}. Exception: {}".format(self.device.name, str(e)), level="WARNING")
+        finally:
+            # A worker is about to free up, so make sure the next waiting device is being decoded
+            if self.prefetcher:
+                self.prefetcher.prefetch_next()
+
+
+class _Prefetcher(object):
+    """
+    Decodes the source images of the device waiting longest for a worker on a background thread,
+    so they are in its prefetch buffer before it is processed.
+    """
+
+    _STOP = object()
+
+    def __init__(self, manager):
+        self.manager = manager
+        # Devices submitted to the pool that no worker has picked up yet, oldest first
+        self._waiting = collections.deque()
+        self._lock = threading.Lock()
+        # A single slot keeps at most one device queued behind the one being decoded
+        self._queue = LinkedBlockingQueue(1)
+        self._thread = Thread(self._run, "HughesLabTools-prefetch")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def add_waiting(self, device):
+        """Records a device that is about to be submitted to the pool."""
+        with self._lock:
+            self._waiting.append(device)
+
+    def device_started(self, device):
+        """Records that a worker picked a device up, then prefetches the next waiting one."""
+        with self._lock:
+            self._waiting.remove(device)
+        self.prefetch_next()
+
+    def prefetch_next(self):
+        """Queues the oldest waiting device for prefetching, dropping the request if the prefetcher is already busy."""
+        with self._lock:
+            if not self._waiting:
+                return
+            device = self._waiting[0]
+        self._queue.offer(device)
+
+    def shutdown(self):
+        """Discards pending requests and waits for the background thread to finish."""
+        self._queue.clear()
+        self._queue.put(self._STOP)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            device = self._queue.take()
+            if device is self._STOP:
+                return
+            with self._lock:
+                # A worker may have picked the device up while the request was queued
+                still_waiting = device in self._waiting
+            if not still_waiting:
+                continue
+            try:
+                device.prefetch_images(self.manager.typeColors, self.manager.options.get("sat", 0.3))
+            except Exception as e:
+                self.manager.log("Prefetch failed for device: {}. Exception: {}".format(device.name, str(e)))
+
+
+_WALK_DONE = object()
+
+
+class _WalkError(object):
+    """Carries an exception from the directory walk thread to the generator consuming it."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class _ImageDirectoryVisitor(SimpleFileVisitor):
+    """
+    Collects the image files of each directory during Files.walkFileTree and queues
+    (directory, image_files) once the walk leaves a directory that contains images.
+    """
+
+    def __init__(self, manager, root, formats, results):
+        SimpleFileVisitor.__init__(self)
+        self.manager = manager
+        self.root = root
+        self.formats = formats
+        self.results = results
+        self.cancelled = False
+        self._open_dirs = []  # Image files of each directory on the current branch of the walk
+
+    def preVisitDirectory(self, directory, attrs):
+        if self.cancelled:
+            return FileVisitResult.TERMINATE
+        # Output and result cache directories hold our own files, so do not walk them at all
+        if not directory.equals(self.root) and directory.getFileName().toString() in _SKIPPED_DIRS:
+            return FileVisitResult.SKIP_SUBTREE
+        self._open_dirs.append([])
+        return FileVisitResult.CONTINUE
+
+    def visitFile(self, path, attrs):
+        # Symbolic links are not followed by the walk, so check what a linked file points to
+        is_file = attrs.isRegularFile() or (attrs.isSymbolicLink() and Files.isRegularFile(path))
+        # Subdirectories beyond the maximum depth are also reported here, and are skipped by the check
+        if is_file and self._open_dirs and DeviceManager._is_valid_format(path.getFileName().toString(), self.formats):
+            self._open_dirs[-1].append(path.toString())
+        return FileVisitResult.CONTINUE
+
+    def visitFileFailed(self, path, exc):
+        # Like os.walk, carry on past entries that cannot be read
+        self.manager.log("Skipping unreadable path {}: {}".format(path, exc), level="WARNING")
+        return FileVisitResult.CONTINUE
+
+    def postVisitDirectory(self, directory, exc):
+        image_files = self._open_dirs.pop()
+        if image_files:
+            self.results.put((directory.toString(), sorted(image_files, key=DeviceManager._natural_sort_key)))
+        return FileVisitResult.TERMINATE if self.cancelled else FileVisitResult.CONTINUE
+
+
 class DeviceManager:
     def __init__(self, rootDir="", numTypes=1, typeNames=None, typeColors=None, verbose=False, options=None):
         # Default settings
@@ -18,6 +165,9 @@ class DeviceManager:
         self.typeNames = typeNames if typeNames else ["Type 1"]
         self.typeColors = typeColors if typeColors else ["Red"]
         self.verbose = verbose
+        self._log_lock = threading.Lock()
+        self._pool = None
+        self._results_cache = None
 
     def configure_with_gui(self):
         """Method to display the GUI, collect options, and configure the DeviceManager."""
@@ -39,13 +189,16 @@ class DeviceManager:
         self.verbose = self.options.get('verbose', self.verbose)
 
     def log(self, message, level="INFO"):
-        if level == "WARNING":
-            print("WARNING: {}".format(message))
-        elif self.verbose and level == "INFO":
-            print("INFO: {}".format(message))
+        # Devices are processed on pool threads, so keep log lines from interleaving
+        with self._log_lock:
+            if level == "WARNING":
+                print("WARNING: {}".format(message))
+            elif self.verbose and level == "INFO":
+                print("INFO: {}".format(message))
 
     def add_device(self, device_name, device_dir, verbose=False):
-        device = Device(typeNames=self.typeNames, name=device_name, deviceDir=device_dir, verbose=verbose)
+        device = Device(typeNames=self.typeNames, name=device_name, deviceDir=device_dir, verbose=verbose,
+                        executor=self._pool, results_cache=self._results_cache, options=self.options)
         self.devices.append(device)
         self.device_dict[device_name] = device
         self.log("Added device: {}".format(device_name))
@@ -105,59 +258,92 @@ class DeviceManager:
         print_dict(self.options, indent=2)
 
     def walk_directory_and_add_images(self, formats=None):
-        if formats is None:
-            formats = ['tif', 'tiff']
-
-        # Gather all image files
-        image_files = []
-        for root, dirs, files in os.walk(self.rootDir):
-            # Process subdirectories based on the GUI options
-            if not self.options.get('process_subdirectories', True):
-                dirs[:] = []
-
-            # Skip directories named 'colored' or 'merged'
-            dirs[:] = [d for d in dirs if d not in ['colored', 'merged']]
-
-            if self.options.get('process_subdirectories', True):
-                self.log("Walking directory and subdirectories: {}".format(root))
-            else:
-                self.log("Walking directory: {}".format(root))
-
-            image_files.extend(self._get_sorted_image_files(root, files, formats))
-
-        # Determine the number of devices needed
-        num_images = len(image_files)
-        if num_images % self.numTypes != 0:
-            self.log("Warning: The number of images is not a multiple of the number of types.")
-            return
-
-        num_devices = num_images // self.numTypes
-
-        # Assign images to devices
-        for device_idx in range(num_devices):
-            device_name = "Device_{}".format(device_idx + 1)
-            # Extract the directory from the first image for this device
-            device_dir = os.path.dirname(image_files[device_idx * self.numTypes])
-            self.add_device(device_name, device_dir, self.verbose)
-            device = self.device_dict[device_name]
-
-            # Assign the correct image to each type for this device
-            for type_idx, img_type in enumerate(self.typeNames):
-                img_index = device_idx * self.numTypes + type_idx
-                if img_index < num_images:
-                    img_file = image_files[img_index]
-                    device.set_image_paths(image_type=img_type, image_path=img_file)
+        """Walks the root directory and adds every device found before returning."""
+        num_devices = 0
+        for device_name, device_dir, image_paths in self._iter_devices(formats):
+            self._add_device_with_images(device_name, device_dir, image_paths)
+            num_devices += 1
 
         self.log("Assigned images to {} devices.".format(num_devices))
 
-    def _get_sorted_image_files(self, root, files, formats):
-        image_files = [os.path.join(root, file) for file in files if self._is_valid_format(file, formats)]
-        image_files = sorted(image_files, key=self._natural_sort_key)
-        return image_files
+    def _iter_devices(self, formats=None):
+        """
+        Walks the root directory and yields (device_name, device_dir, image_paths) as soon as
+        enough images for a device have been found, so processing can start before the walk ends.
+        """
+        if formats is None:
+            formats = ['tif', 'tiff']
+
+        if self.options.get('process_subdirectories', True):
+            self.log("Walking directory and subdirectories: {}".format(self.rootDir))
+        else:
+            self.log("Walking directory: {}".format(self.rootDir))
+
+        num_devices = 0
+        for root, image_files in self._iter_image_directories(formats):
+            self.log("Found {} images in directory: {}".format(len(image_files), root))
+            # A device's images share a directory, so leftovers are dropped here rather than paired
+            # with the next directory's images, which would shift every later device
+            leftover = len(image_files) % self.numTypes
+            if leftover:
+                self.log("The number of images in {} is not a multiple of the number of types. "
+                         "Skipping {} leftover image(s).".format(root, leftover), level="WARNING")
+            for start in range(0, len(image_files) - leftover, self.numTypes):
+                num_devices += 1
+                device_files = image_files[start:start + self.numTypes]
+                # Extract the directory from the first image for this device
+                yield "Device_{}".format(num_devices), os.path.dirname(device_files[0]), device_files
+
+    def _add_device_with_images(self, device_name, device_dir, image_paths):
+        """Adds a device and assigns one image to each type, in order."""
+        self.add_device(device_name, device_dir, self.verbose)
+        device = self.device_dict[device_name]
+
+        # Assign the correct image to each type for this device
+        for img_type, img_file in zip(self.typeNames, image_paths):
+            device.set_image_paths(image_type=img_type, image_path=img_file)
+        return device
+
+    def _iter_image_directories(self, formats):
+        """
+        Yields (directory, image_files) for each directory under the root that contains images,
+        with the files of each directory in natural sort order.
+
+        The tree is walked with Files.walkFileTree on a background thread, which hands over the file
+        attributes read during the walk rather than stat-ing every entry again, and never descends
+        into the output and result cache directories. A directory is yielded as soon as the walk has
+        left it, so directories come out after their subdirectories.
+        """
+        # Process subdirectories based on the GUI options
+        max_depth = Integer.MAX_VALUE if self.options.get('process_subdirectories', True) else 1
+        results = LinkedBlockingQueue()
+        visitor = _ImageDirectoryVisitor(self, Paths.get(self.rootDir), formats, results)
+
+        def walk():
+            try:
+                Files.walkFileTree(visitor.root, EnumSet.noneOf(FileVisitOption), max_depth, visitor)
+                results.put(_WALK_DONE)
+            except Exception as e:
+                results.put(_WalkError(e))
+
+        walker = Thread(walk, "HughesLabTools-walk")
+        walker.setDaemon(True)
+        walker.start()
+        try:
+            while True:
+                item = results.take()
+                if item is _WALK_DONE:
+                    return
+                if isinstance(item, _WalkError):
+                    raise item.error
+                yield item
+        finally:
+            # Stops the walk early if the caller abandons the generator
+            visitor.cancelled = True
 
     @staticmethod
     def _natural_sort_key(s):
-        return [int(text) if text.isdigit() else text.lower() for text in re.split(r'([0-9]+)', s)]
+        return [int(text) if text.isdigit() else text.lower() for text in _NAT_SORT_RE.split(s)]
 
     @staticmethod
     def _is_valid_format(file_name, formats):
@@ -166,29 +352,85 @@ class DeviceManager:
 
     def run_selected_processes(self):
         """Run all selected processes based on the options configuration."""
-        self.walk_directory_and_add_images()  # Always walk the directory
+        self._results_cache = self._open_results_cache()
+
+        # Devices are independent, so color and merge them on a bounded pool while the walk continues
+        num_threads = Runtime.getRuntime().availableProcessors()
+        pool = Executors.newFixedThreadPool(num_threads)
+        # Devices added during this run share the pool for coloring their images in parallel
+        self._pool = pool
+
+        # Source images are only read by the color stage, so that is the only stage worth prefetching for
+        prefetcher = _Prefetcher(self) if self.options.get("color") else None
+        queued_devices = []
+        futures = []
+        try:
+            for device_name, device_dir, image_paths in self._iter_devices():  # Always walk the directory
+                device = self._add_device_with_images(device_name, device_dir, image_paths)
+                self._confirm_device_image_types(device)
+
+                # Only queue the device once its image types are final, so a running task never
+                # hands it to the prefetcher while the confirmation dialog is still changing them
+                queued_devices.append(device)
+                if prefetcher:
+                    prefetcher.add_waiting(device)
+                futures.append(pool.submit(_DeviceTask(self, device, prefetcher)))
+
+            if not queued_devices:
+                self.log("No devices to process.")
+
+            for future in futures:
+                future.get()
+        finally:
+            self._pool = None
+            pool.shutdown()
+            if self._results_cache:
+                self._results_cache.save()
+                self._results_cache = None
+            if prefetcher:
+                prefetcher.shutdown()
+            for device in queued_devices:
+                # Drop anything prefetched for a device that had already been processed
+                device.clear_image_cache()
+
+        # Garbage collection
+        System.gc()
 
-        # Process each device
-        for device in self.devices:
-            # Confirm image types
-            if self.options.get('confirm_image_types'):
-                    self.log("Confirming image types for device: {}".format(device.name))
-                    changer = ImageTypeChangerGui(device)
-                    changer.confirm_and_change_image_type()
+        self.log("Finished processing all devices.")
 
+    def _open_results_cache(self):
+        """Returns the results cache for the root directory, or None when caching is disabled."""
+        if not (self.options.get('use_cache') or self.options.get('clear_cache')):
+            return None
+
+        results_cache = ResultsCache(self.rootDir, verbose=self.verbose)
+        if self.options.get('clear_cache'):
+            results_cache.clear()
+        if not self.options.get('use_cache'):
+            return None
+        return results_cache
+
+    def _confirm_device_image_types(self, device):
+        """Lets the user confirm or change a device's image types, if requested."""
+        # Confirming image types is interactive, so it runs on this thread while earlier devices process
+        if self.options.get('confirm_image_types'):
+            self.log("Confirming image types for device: {}".format(device.name))
+            changer = ImageTypeChangerGui(device)
+            changer.confirm_and_change_image_type()
+
+    def _process_device(self, device):
+        """Apply color to and merge the images of a single device."""
+        try:
             # Apply color to images
             if self.options.get("color"):
-                    self.log("Applying color to device: {}".format(device.name))
-                    device.apply_color_to_images(self.typeColors, self.options.get("sat", 0.3), self.options.get('show_colored', False))
+                self.log("Applying color to device: {}".format(device.name))
+                device.apply_color_to_images(self.typeColors, self.options.get("sat", 0.3), self.options.get('show_colored', False))
 
             # Merge images
             if self.options.get("merge"):
-                    self.log("Merging images for device: {}".format(device.name))
-                    device.merge_images(self.options.get('show_merged', False))
-
-            # Garbage collection
-            System.gc()
-
-        self.log("Finished processing all devices.")
-
-
+                self.log("Merging images for device: {}".format(device.name))
+                device.merge_images(self.options.get('show_merged', False))
+        finally:
+            # Nothing reads a device's images after this, so do not hold them for the rest of the run
+            device.clear_image_cache()
+            device.clear_colored_images()
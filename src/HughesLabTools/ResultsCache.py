@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from ij import IJ
+
+
+class ResultsCache:
+    """
+    A persistent record of the outputs written by previous runs, keyed by a hash of their inputs.
+
+    A key covers the path, modification time and size of every input file plus the processing
+    parameters, so an entry only matches when neither the sources nor the settings have changed.
+    Each result is copied into a '.hlt_cache' directory under the root directory, named after its
+    key, so a later run with different settings overwriting the output does not invalidate it.
+
+    Attributes:
+        cache_dir (str): The directory holding the cached results and the manifest.
+        manifest_path (str): The path of the JSON manifest mapping keys to cached file names.
+    """
+
+    CACHE_DIR_NAME = '.hlt_cache'
+    MANIFEST_NAME = 'manifest.json'
+
+    def __init__(self, rootDir, verbose=False):
+        self.cache_dir = os.path.join(rootDir, self.CACHE_DIR_NAME)
+        self.manifest_path = os.path.join(self.cache_dir, self.MANIFEST_NAME)
+        self.verbose = verbose
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def log(self, message, level="INFO"):
+        if level == "WARNING":
+            IJ.log("WARNING: [ResultsCache] {}".format(message))
+        elif level == "INFO" and self.verbose:
+            IJ.log("INFO: [ResultsCache] {}".format(message))
+
+    @staticmethod
+    def make_key(input_paths, *params):
+        """
+        Builds a cache key from input files and processing parameters.
+
+        Args:
+            input_paths (list): The files the output is computed from.
+            *params: Any parameters that change the output (e.g. color and saturation).
+
+        Returns:
+            str: A hex SHA-1 digest identifying this combination of inputs and parameters.
+        """
+        digest = hashlib.sha1()
+        for path in input_paths:
+            stat = os.stat(path)
+            for part in (path, stat.st_mtime, stat.st_size):
+                digest.update(str(part).encode('utf-8'))
+        for param in params:
+            digest.update(str(param).encode('utf-8'))
+        return digest.hexdigest()
+
+    def contains(self, key):
+        """Returns True if a cached result exists for the key, without restoring it."""
+        return self._cached_path(key) is not None
+
+    def lookup(self, key, output_path):
+        """
+        Restores a cached output to output_path if one exists for the key.
+
+        Returns:
+            bool: True if output_path now holds the cached result, False on a cache miss.
+        """
+        cached_path = self._cached_path(key)
+        if cached_path is None:
+            return False
+
+        # copy2 keeps the cached modification time, so keys built over this output (e.g. the
+        # merge key over colored images) match the ones recorded when it was first computed
+        shutil.copy2(cached_path, output_path)
+        self.log("Reusing cached result: {}".format(output_path))
+        return True
+
+    def store(self, key, output_path):
+        """Copies output_path into the cache as the result for the key."""
+        cached_name = key + os.path.splitext(output_path)[1]
+        with self._lock:
+            self._ensure_cache_dir()
+        shutil.copy2(output_path, os.path.join(self.cache_dir, cached_name))
+        with self._lock:
+            self._entries[key] = cached_name
+            self._dirty = True
+
+    def save(self):
+        """Writes the manifest to disk if it has changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._ensure_cache_dir()
+            with open(self.manifest_path, 'w') as manifest:
+                json.dump(self._entries, manifest, indent=2, sort_keys=True)
+            self._dirty = False
+        self.log("Saved cache manifest: {}".format(self.manifest_path))
+
+    def clear(self):
+        """Forgets every cached result and removes the cache directory."""
+        with self._lock:
+            self._entries = {}
+            self._dirty = False
+            if os.path.isdir(self.cache_dir):
+                shutil.rmtree(self.cache_dir)
+        self.log("Cleared result cache: {}".format(self.cache_dir))
+
+    def _cached_path(self, key):
+        """Returns the path of the cached result for the key, or None if there is none."""
+        with self._lock:
+            cached_name = self._entries.get(key)
+        if not cached_name:
+            return None
+        cached_path = os.path.join(self.cache_dir, cached_name)
+        return cached_path if os.path.isfile(cached_path) else None
+
+    def _ensure_cache_dir(self):
+        # Called with the lock held, so threads storing results at once cannot race on creating it
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _load(self):
+        if not os.path.isfile(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path) as manifest:
+                entries = json.load(manifest)
+        except (IOError, ValueError) as e:
+            self.log("Ignoring unreadable cache manifest {}: {}".format(self.manifest_path, str(e)), level="WARNING")
+            return
+        # Only keep entries naming a file inside the cache directory; older manifests pointed at the
+        # output files themselves, which later runs may have overwritten
+        self._entries = {key: name for key, name in entries.items()
+                         if isinstance(name, basestring) and os.path.basename(name) == name}
@@ -25,9 +25,8 @@ class TumorImage(DeviceImage):
 
     def save_results(self, img, results_table):
         base_dir = self.getOriginalFileInfo().directory
+        # self.save creates the directory, so results_table.saveAs can rely on it existing
         segmented_dir = join(base_dir, 'segmented')
-        if not os.path.exists(segmented_dir):
-            os.makedirs(segmented_dir)
         segmented_path = join(segmented_dir, splitext(self.getTitle())[0] + '_segmented.jpg')
         results_path = join(segmented_dir, splitext(self.getTitle())[0] + '_results.csv')
         self.save(segmented_path)
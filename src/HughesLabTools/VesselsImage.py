@@ -1,5 +1,3 @@
-from ij import IJ, Prefs
-import os
 from os.path import join, splitext
 from HughesLabTools.DeviceImage import DeviceImage
 
@@ -26,14 +24,11 @@ class VesselImage(DeviceImage):
         imp2.setTitle(splitext(self.getTitle())[0] + '_threshold')
 
         # Apply threshold and convert to mask
-        IJ.setAutoThreshold(imp2, 'Li dark b&w')
-        Prefs.blackBackground = True
-        IJ.run(imp2, 'Convert to Mask', '')
+        DeviceImage.convert_to_mask(imp2, 'Li dark b&w', black_background=True)
 
         # Save the thresholded image
+        # self.save creates the directory if it does not exist yet
         output_dir = join(self.getOriginalFileInfo().directory, 'thresholded')
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
         output_path = join(output_dir, splitext(self.getTitle())[0] + '_thresholded.jpg')
         self.save(output_path)
 
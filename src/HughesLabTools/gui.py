@@ -1,5 +1,25 @@
 from __future__ import print_function, division, absolute_import
-from ij import IJ, gui
+from ij import IJ, ImagePlus, gui
+from ij.process import ImageProcessor
+from java.awt import BorderLayout, Choice, GridLayout, Panel
+from java.io import File
+from java.lang import String
+from java.util.concurrent import Callable, Executors
+from javax.swing import ImageIcon, JLabel
+import jarray
+import os
+
+_POSSIBLE_COLORS = ('Red', 'Green', 'Blue', 'Cyan', 'Magenta', 'Yellow')
+_DEFAULT_NAMES = ('Vessels', 'Tumor', 'Fibroblasts', 'Cell 1', 'Cell 2', 'Cell 3')
+_TYPE_COUNT_CHOICES = tuple(str(x + 1) for x in range(len(_DEFAULT_NAMES)))
+
+# GenericDialog.addChoice takes a String[]; convert once instead of on every call
+_COLOR_CHOICE_ITEMS = jarray.array(_POSSIBLE_COLORS, String)
+_TYPE_COUNT_CHOICE_ITEMS = jarray.array(_TYPE_COUNT_CHOICES, String)
+
+# Options set as DeviceManager attributes rather than kept in its options dictionary
+_DEVICE_ATTR_KEYS = frozenset(('numTypes', 'typeNames', 'typeColors', 'rootDir', 'verbose'))
+
 
 class VmoToolsGui:
     """
@@ -31,9 +51,6 @@ class VmoToolsGui:
         if not self._collect_function_options():
             return None
 
-        if not self._collect_number_of_image_types():
-            return None
-
         if not self._collect_additional_options():
             return None
 
@@ -54,11 +71,28 @@ class VmoToolsGui:
 
     def _collect_function_options(self):
         """
-        Collects the main function options from the user through a dialog.
+        Collects the main function options and the number of image types from the user through a single dialog.
 
         Returns:
             bool: True if the dialog is not canceled, False otherwise.
         """
+        dialog, radio_buttons = self._build_combined_initial_dialog()
+        dialog.showDialog()
+
+        if dialog.wasCanceled():
+            return False
+
+        self._parse_function_options(dialog, radio_buttons)
+        self.num_types = int(dialog.getNextChoice())  # Store numTypes separately
+        return True
+
+    def _build_combined_initial_dialog(self):
+        """
+        Builds the first dialog, holding the coloring, tumor and vessel tools and the number of image types.
+
+        Returns:
+            tuple: The GenericDialog and the list of radio button labels for the image coloring options.
+        """
         dialog = gui.GenericDialog('Run VMO Tools')
         radio_buttons = ['Color and Merge Images', 'Color Images', 'No Coloring']
         dialog.addRadioButtonGroup('Image Coloring Tools:', radio_buttons, 3, 1, radio_buttons[0])
@@ -73,14 +107,14 @@ class VmoToolsGui:
         vessel_checkbox_labels = ['Threshold Vessel Images', 'Measure Vessel Diameter']
         dialog.addCheckboxGroup(2, 1, vessel_checkbox_labels, [False] * 2)
 
-        dialog.setOKLabel('Next ...')
-        dialog.showDialog()
-
-        if dialog.wasCanceled():
-            return False
+        dialog.setInsets(15, 10, 0)
+        dialog.addMessage('How many image types are in the directories you are processing?')
+        dialog.addMessage('Examples:\nVessels and Tumors = 2\nVessels, Tumors, and Fibroblasts = 3')
+        dialog.setInsets(5, 60, 5)
+        dialog.addChoice('', _TYPE_COUNT_CHOICE_ITEMS, _TYPE_COUNT_CHOICES[1])
 
-        self._parse_function_options(dialog, radio_buttons)
-        return True
+        dialog.setOKLabel('Next ...')
+        return dialog, radio_buttons
 
     def _parse_function_options(self, dialog, radio_buttons):
         """
@@ -116,33 +150,6 @@ class VmoToolsGui:
         else:
             return False, False
 
-    def _collect_number_of_image_types(self):
-        """
-        Collects the number of image types the user wants to process.
-
-        Returns:
-            bool: True if the dialog is not canceled, False otherwise.
-        """
-        dialog = gui.GenericDialog('Number of Image Types')
-        if self.options['color']:
-            dialog.addMessage('How many image types are you processing?')
-        else:
-            dialog.addMessage('How many image types are in the directories you are processing?')
-
-        dialog.addMessage('Examples:\nVessels and Tumors = 2\nVessels, Tumors, and Fibroblasts = 3')
-        dialog.setInsets(5, 60, 5)
-
-        dialog.addChoice('', [str(x + 1) for x in range(6)], '2')
-
-        dialog.setOKLabel('Next ...')
-        dialog.showDialog()
-
-        if dialog.wasCanceled():
-            return False
-
-        self.num_types = int(dialog.getNextChoice())  # Store numTypes separately
-        return True
-
     def _collect_additional_options(self):
         """
         Collects additional options such as image type names and colors.
@@ -151,18 +158,19 @@ class VmoToolsGui:
             bool: True if the dialog is not canceled, False otherwise.
         """
         dialog = gui.GenericDialog('Image Type Names and Colors')
-        possible_colors = ['Red', 'Green', 'Blue', 'Cyan', 'Magenta', 'Yellow']
-        default_names = ['Vessels', 'Tumor', 'Fibroblasts', 'Cell 1', 'Cell 2', 'Cell 3']
-
         type_names, type_colors = [], []
 
+        # Bind the dialog methods once; each attribute lookup goes through Java reflection
+        add_msg, set_insets = dialog.addMessage, dialog.setInsets
+        add_choice, add_same_row, add_str = dialog.addChoice, dialog.addToSameRow, dialog.addStringField
+        color = self.options['color']
         for i in range(self.num_types):
-            dialog.addMessage('Image Type: ' + str(i + 1))
-            dialog.setInsets(5, 20, 0)
-            if self.options['color']:
-                dialog.addChoice('Color:', possible_colors, possible_colors[i])
-                dialog.addToSameRow()
-            dialog.addStringField('Name:', default_names[i], 10)
+            add_msg('Image Type: ' + str(i + 1))
+            set_insets(5, 20, 0)
+            if color:
+                add_choice('Color:', _COLOR_CHOICE_ITEMS, _POSSIBLE_COLORS[i])
+                add_same_row()
+            add_str('Name:', _DEFAULT_NAMES[i], 10)
 
         self._add_optional_dialog_sections(dialog)
 
@@ -172,9 +180,10 @@ class VmoToolsGui:
         if dialog.wasCanceled():
             return False
 
+        get_str, get_choice = dialog.getNextString, dialog.getNextChoice
         for i in range(self.num_types):
-            type_names.append(dialog.getNextString())
-            type_colors.append(dialog.getNextChoice())
+            type_names.append(get_str())
+            type_colors.append(get_choice())
 
         # Store these directly in the DeviceManager (or wherever you want to store them)
         self.type_names = type_names
@@ -277,14 +286,27 @@ class VmoToolsGui:
         Args:
             dialog (GenericDialog): The dialog instance where the file options will be added.
         """
-        dialog.setInsets(25, 20, 0)
-        dialog.addMessage('File Options:')
-        dialog.setInsets(5, 25, 0)
-        dialog.addCheckbox('Process images in subdirectories', self.options.get('process_subdirectories', True))
-        dialog.addToSameRow()
-        dialog.addCheckbox('Confirm image types', self.options.get('confirm_image_types', False))
-        dialog.setInsets(5, 25, 0)
-        dialog.addCheckbox('Verbose Logging', self.options.get('verbose', False))
+        add_msg, set_insets = dialog.addMessage, dialog.setInsets
+        add_cb, add_same_row = dialog.addCheckbox, dialog.addToSameRow
+        get = self.options.get
+        set_insets(25, 20, 0)
+        add_msg('File Options:')
+        set_insets(5, 25, 0)
+        add_cb('Process images in subdirectories', get('process_subdirectories', True))
+        add_same_row()
+        add_cb('Confirm image types', get('confirm_image_types', False))
+        set_insets(5, 25, 0)
+        add_cb('Verbose Logging', get('verbose', False))
+        add_same_row()
+        add_cb('Overwrite existing outputs', get('force', False))
+        set_insets(5, 25, 0)
+        add_cb('Reuse cached results', get('use_cache', False))
+        add_same_row()
+        add_cb('Clear result cache', get('clear_cache', False))
+        set_insets(5, 25, 0)
+        add_cb('Review image types as thumbnails', get('batch_review', True))
+        add_same_row()
+        add_cb('Downsize images for review', get('fast_review', True))
 
     def _finalize_additional_options(self, dialog):
         """
@@ -293,26 +315,28 @@ class VmoToolsGui:
         Args:
             dialog (GenericDialog): The dialog instance from which final options are retrieved.
         """
-        if self.options['color']:
-            self.options['show_colored'] = dialog.getNextBoolean()
-            self.options['sat'] = dialog.getNextNumber()
-        if self.options['merge']:
-            self.options['show_merged'] = dialog.getNextBoolean()
-        if self.options['segment']:
-            self.options['show_segmented'] = dialog.getNextBoolean()
-        if self.options['threshold']:
-            self.options['show_threshold'] = dialog.getNextBoolean()
-        if self.options['meas_diam']:
-            self.options['vessel_settings'] = dialog.getNextBoolean()
-        if self.options['meas_circ']:
-            self.options['circ_bp'] = dialog.getNextNumber()
-            self.options['circ_st'] = dialog.getNextNumber()
-            self.options['circ_lt'] = dialog.getNextNumber()
+        options = self.options
+        get_bool, get_num = dialog.getNextBoolean, dialog.getNextNumber
+        if options['color']:
+            options['show_colored'] = get_bool()
+            options['sat'] = get_num()
+        if options['merge']:
+            options['show_merged'] = get_bool()
+        if options['segment']:
+            options['show_segmented'] = get_bool()
+        if options['threshold']:
+            options['show_threshold'] = get_bool()
+        if options['meas_diam']:
+            options['vessel_settings'] = get_bool()
+        if options['meas_circ']:
+            options['circ_bp'] = get_num()
+            options['circ_st'] = get_num()
+            options['circ_lt'] = get_num()
 
         # Only store operational options in self.options
-        self.options['process_subdirectories'] = dialog.getNextBoolean()
-        self.options['confirm_image_types'] = dialog.getNextBoolean()
-        self.options['verbose'] = dialog.getNextBoolean()
+        for key in ('process_subdirectories', 'confirm_image_types', 'verbose', 'force', 'use_cache', 'clear_cache',
+                    'batch_review', 'fast_review'):
+            options[key] = get_bool()
 
     def _collect_root_directory(self):
         """
@@ -340,13 +364,57 @@ class VmoToolsGui:
 
         # Set the operational options (excluding numTypes, typeNames, typeColors, and rootDir)
         device_manager.options = {
-            k: v for k, v in self.options.items() if k not in ['numTypes', 'typeNames', 'typeColors', 'rootDir', 'verbose']
+            k: v for k, v in self.options.iteritems() if k not in _DEVICE_ATTR_KEYS
         }
 
         # Apply the options to the device manager
         device_manager._apply_gui_options()
 
 
+def _scale_to_fit(ip, max_dim):
+    """Returns ip scaled down so neither side exceeds max_dim pixels, or ip itself if it already fits."""
+    width, height = ip.getWidth(), ip.getHeight()
+    if max(width, height) <= max_dim:
+        return ip
+    scale = float(max_dim) / max(width, height)
+    ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+    return ip.resize(max(1, int(width * scale)), max(1, int(height * scale)), True)
+
+
+def _open_image(image_path, max_dim=None):
+    """
+    Opens an image, optionally replacing it with a copy scaled down to fit within max_dim pixels.
+
+    Args:
+        image_path (str): The file path of the image.
+        max_dim (int, optional): The largest width or height to keep. Defaults to None (full resolution).
+
+    Returns:
+        ImagePlus: The opened image, or None if it could not be opened.
+    """
+    image = IJ.openImage(image_path)
+    if image is None or not max_dim:
+        return image
+
+    ip = image.getProcessor()
+    scaled = _scale_to_fit(ip, max_dim)
+    if scaled is ip:
+        return image
+    image.flush()
+    return ImagePlus(image.getTitle(), scaled)
+
+
+class _OpenImageTask(Callable):
+    """Opens an image on a background thread."""
+
+    def __init__(self, image_path, max_dim=None):
+        self.image_path = image_path
+        self.max_dim = max_dim
+
+    def call(self):
+        return _open_image(self.image_path, self.max_dim)
+
+
 class ImageTypeChangerGui:
     """
     A GUI class for confirming or changing image types within a device.
@@ -355,6 +423,10 @@ class ImageTypeChangerGui:
         device (Device): The device containing images to confirm or change types for.
     """
 
+    GRID_COLUMNS = 4
+    THUMBNAIL_SIZE = 128
+    REVIEW_MAX_SIZE = 1024
+
     def __init__(self, device):
         """Initializes the ImageTypeChangerGui with a device."""
         self.device = device
@@ -363,37 +435,188 @@ class ImageTypeChangerGui:
         """
         Iterates through all images in the device and allows the user to confirm or change their types.
         """
-        for img_type, image_paths in self.device.get_image_paths().items():
-            if not image_paths:
-                continue
+        work = self._collect_work()
+        if not work:
+            return
+
+        if len(work) > 1 and self.device.options.get('batch_review', True):
+            self._review_as_grid(work)
+        else:
+            self._review_one_by_one(work)
+
+    def _collect_work(self):
+        """
+        Flattens the device's image paths into the sequence of images to review.
+        Files that no longer exist are left out so no load is attempted for them.
 
-            image_paths = self._ensure_list(image_paths)
-            valid_types = self.device.get_typeNames()
+        Returns:
+            list: (image type, image path) pairs, in type order.
+        """
+        work = [(img_type, image_path)
+                for img_type, image_paths in self.device.get_image_paths().items() if image_paths
+                for image_path in (image_paths if isinstance(image_paths, list) else [image_paths])]
+
+        # Check each file once, keeping the missing ones only to report them
+        existing, missing = [], []
+        for item in work:
+            (existing if File(item[1]).isFile() else missing).append(item)
+        if self.device.verbose:
+            for img_type, image_path in missing:
+                print("Skipping missing image: {}".format(image_path))
+        return existing
+
+    def _review_as_grid(self, work):
+        """
+        Shows thumbnails of all images on one dialog and applies the types the user picks.
+
+        Args:
+            work (list): (image type, image path) pairs to review.
+        """
+        valid_types = self.device.get_typeNames()
+        dialog, choices = self._build_review_grid(work, valid_types)
+        dialog.showDialog()
+
+        if dialog.wasCanceled():
+            return
 
-            for image_path in image_paths:
-                new_type = self._show_image_and_get_new_type(image_path, img_type, valid_types)
-                if new_type and new_type != img_type:
-                    self._update_image_type(image_path, img_type, new_type)
+        for (img_type, image_path), choice in zip(work, choices):
+            new_type = choice.getSelectedItem()
+            if new_type and new_type != img_type:
+                self._update_image_type(image_path, img_type, new_type)
 
-    def _show_image_and_get_new_type(self, image_path, current_type, valid_types):
+    def _build_review_grid(self, work, valid_types):
+        """
+        Builds a dialog showing a thumbnail and a type selector for every image.
+
+        Args:
+            work (list): (image type, image path) pairs to review.
+            valid_types (list): A list of valid image types to choose from.
+
+        Returns:
+            tuple: The GenericDialog and the list of Choice selectors, in the same order as work.
+        """
+        columns = min(len(work), self.GRID_COLUMNS)
+        grid = Panel(GridLayout(0, columns, 10, 10))
+        choices = []
+        for img_type, image_path in work:
+            label = JLabel(os.path.basename(image_path), JLabel.CENTER)
+            label.setVerticalTextPosition(JLabel.BOTTOM)
+            label.setHorizontalTextPosition(JLabel.CENTER)
+            thumbnail = self._make_thumbnail(image_path)
+            if thumbnail is not None:
+                label.setIcon(ImageIcon(thumbnail))
+
+            choice = Choice()
+            for valid_type in valid_types:
+                choice.add(valid_type)
+            choice.select(img_type)
+            choices.append(choice)
+
+            tile = Panel(BorderLayout())
+            tile.add(label, BorderLayout.CENTER)
+            tile.add(choice, BorderLayout.SOUTH)
+            grid.add(tile)
+
+        dialog = gui.GenericDialog("Confirm or Change Image Types")
+        dialog.addMessage("Device: {}".format(self.device.name))
+        dialog.addPanel(grid)
+        dialog.setOKLabel("Apply")
+        dialog.setCancelLabel("Cancel")
+        return dialog, choices
+
+    def _make_thumbnail(self, image_path):
+        """
+        Opens an image and scales it down to fit within THUMBNAIL_SIZE pixels.
+
+        Args:
+            image_path (str): The file path of the image.
+
+        Returns:
+            java.awt.Image: The thumbnail, or None if the image could not be opened.
+        """
+        image = IJ.openImage(image_path)
+        if image is None:
+            return None
+        try:
+            return _scale_to_fit(image.getProcessor(), self.THUMBNAIL_SIZE).createImage()
+        finally:
+            image.flush()
+
+    def _review_one_by_one(self, work):
+        """
+        Shows each image in turn and lets the user confirm or change its type.
+
+        Args:
+            work (list): (image type, image path) pairs to review.
+        """
+        # A downsized copy is enough to recognise the image type; changing the type only moves
+        # the path between types, so the full-resolution pixels are never needed here
+        fast_review = self.device.options.get('fast_review', True)
+        max_dim = self.REVIEW_MAX_SIZE if fast_review else None
+        valid_types = self.device.get_typeNames()
+
+        # Decode the next image in the background while the user reviews the current one
+        loader = Executors.newSingleThreadExecutor()
+        try:
+            pending = loader.submit(_OpenImageTask(work[0][1], max_dim))
+            for idx, (img_type, image_path) in enumerate(work):
+                image = self._get_prefetched_image(pending, image_path, max_dim)
+                if idx + 1 < len(work):
+                    pending = loader.submit(_OpenImageTask(work[idx + 1][1], max_dim))
+
+                if image is None:
+                    if self.device.verbose:
+                        print("Skipping unreadable image: {}".format(image_path))
+                    continue
+
+                try:
+                    new_type = self._show_image_and_get_new_type(image, img_type, valid_types)
+                    if new_type and new_type != img_type:
+                        self._update_image_type(image_path, img_type, new_type, image)
+                finally:
+                    image.close()
+        finally:
+            loader.shutdownNow()
+
+    def _get_prefetched_image(self, pending, image_path, max_dim=None):
+        """
+        Returns the image opened in the background, opening it on this thread if that failed.
+
+        Args:
+            pending (Future): The background load of the image.
+            image_path (str): The file path of the image.
+            max_dim (int, optional): The largest width or height to keep. Defaults to None (full resolution).
+
+        Returns:
+            ImagePlus: The opened image, or None if it could not be opened.
+        """
+        try:
+            image = pending.get()
+            if image is not None:
+                return image
+        except Exception as e:
+            if self.device.verbose:
+                print("Background load failed for {}: {}".format(image_path, e))
+        if not File(image_path).isFile():
+            return None
+        return _open_image(image_path, max_dim)
+
+    def _show_image_and_get_new_type(self, image, current_type, valid_types):
         """
         Displays the image and prompts the user to confirm or change its type.
+        The image is left open; the caller closes it once any type change is applied.
 
         Args:
-            image_path (str): The file path of the image to display.
+            image (ImagePlus): The opened image to display.
             current_type (str): The current image type.
             valid_types (list): A list of valid image types to choose from.
 
         Returns:
             str: The new image type selected by the user, or None if canceled.
         """
-        image = IJ.openImage(image_path)
         image.show()
 
-        new_type = self._get_user_input(current_type, valid_types)
-
-        image.close()
-        return new_type
+        return self._get_user_input(current_type, valid_types)
 
     def _get_user_input(self, current_type, valid_types):
         """
@@ -418,7 +641,7 @@ class ImageTypeChangerGui:
 
         return dialog.getNextRadioButton()
 
-    def _update_image_type(self, image_path, old_type, new_type):
+    def _update_image_type(self, image_path, old_type, new_type, image=None):
         """
         Updates the image type and logs the change if verbose mode is enabled.
 
@@ -426,21 +649,9 @@ class ImageTypeChangerGui:
             image_path (str): The file path of the image to update.
             old_type (str): The old image type.
             new_type (str): The new image type.
+            image (ImagePlus, optional): The already opened image, so the file is not decoded again.
         """
-        image = self.device._load_image(image_path)
         self.device.update_image_type(image_path, old_type, new_type, image)
 
         if self.device.verbose:
             print("Image type changed: {} from {} to {}".format(image_path, old_type, new_type))
-
-    def _ensure_list(self, item):
-        """
-        Ensures that the provided item is returned as a list.
-
-        Args:
-            item: The item to ensure as a list.
-
-        Returns:
-            list: The item as a list, or a list containing the item if it was not already a list.
-        """
-        return item if isinstance(item, list) else [item]